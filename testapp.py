@@ -1,11 +1,27 @@
 import streamlit as st
-import google.generativeai as genai
+import copy
 import json
-import time
 import urllib.parse
 import random
-import uuid
+import re
+import textwrap
+import unicodedata
 import hashlib
+import threading
+import time
+import types
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+# orjson（C 實作）解析與序列化速度較快；未安裝時退回標準函式庫。_json_dumps 一律回傳 UTF-8 bytes
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 # ==========================================
 # 系統設定與學術常數定義
@@ -17,7 +33,6 @@ st.set_page_config(page_title="教育適性化評量系統", page_icon="🎓", l
 try:
     if "GOOGLE_API_KEY" in st.secrets:
         API_KEY = st.secrets["GOOGLE_API_KEY"]
-        genai.configure(api_key=API_KEY)
     else:
         st.error("❌ 未偵測到 API Key。請設定 secrets.toml (本地) 或 Secrets (雲端)。")
         st.stop() 
@@ -28,6 +43,38 @@ except Exception as e:
     st.error(f"❌ 金鑰設定發生錯誤: {str(e)}")
     st.stop()
 
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# show_spinner=False：可能在背景執行緒（預熱、診斷）中首次建立，不可對頁面送出 spinner
+@st.cache_resource(show_spinner=False)
+def _genai():
+    """延遲載入 Gemini SDK：第一次真正呼叫模型時才 import 並設定金鑰，加快冷啟動"""
+    import google.generativeai as genai
+    genai.configure(api_key=API_KEY)
+    return genai
+
+@st.cache_resource(show_spinner=False)
+def get_model(name, system_instruction=None):
+    """全 server 共用的模型物件（每組 name / system_instruction 各一個），避免每次呼叫都重建 SDK 與連線"""
+    return _genai().GenerativeModel(name, system_instruction=system_instruction)
+
+def _warm_up():
+    try:
+        get_model(GEMINI_MODEL).count_tokens("warm")
+    except Exception:
+        pass  # 預熱失敗不影響正式請求，之後照常建立連線
+
+@st.cache_resource
+def warm_up_connection():
+    """
+    每個 process 只執行一次：在背景載入 SDK 並送出極小的 count_tokens 請求，
+    讓 DNS / TLS 握手與老師填表的時間重疊，第一次出題時連線已建立好。
+    """
+    # 不附上 ScriptRunContext：背景執行緒不可寫入頁面元素，cache_resource 在無 context 時仍可正常運作
+    thread = threading.Thread(target=_warm_up, daemon=True)
+    thread.start()
+    return thread
+
 # [評量類型定義] 包含詳細的出題策略與理論基礎
 ASSESSMENT_TYPES = {
     'placement': {
@@ -90,107 +137,76 @@ ASSESSMENT_TYPES = {
     }
 }
 
+# 科目代碼與顯示名稱，以及評量類型選單文字：於載入時建立一次，避免每次 rerun 重建
+# 以唯讀 MappingProxyType 包裝，避免任何 session 不小心改動共用常數
+SUBJECT_MAP = types.MappingProxyType({'chinese': '國語', 'math': '數學', 'science': '自然科學', 'social': '社會'})
+GRADE_LABELS = types.MappingProxyType({i: f"{i} 年級" for i in range(1, 7)})
+ASSESSMENT_LABEL_DESC = types.MappingProxyType({k: f"{v['label']} - {v['desc']}" for k, v in ASSESSMENT_TYPES.items()})
+
+# 學生連結的參數名稱與順序，須與 main() 解析連結時讀取的 key 一致
+_PARAM_KEYS = ("role", "subject", "grade", "unit", "type", "num_q")
+
 # ==========================================
 # 初始化 Session State
 # ==========================================
-if 'app_state' not in st.session_state:
-    st.session_state.app_state = 'input' 
-if 'questions' not in st.session_state:
-    st.session_state.questions = []
-if 'current_q_index' not in st.session_state:
-    st.session_state.current_q_index = 0
-if 'history' not in st.session_state:
-    st.session_state.history = []
-if 'show_explanation' not in st.session_state:
-    st.session_state.show_explanation = False
-if 'user_answer' not in st.session_state:
-    st.session_state.user_answer = None
-if 'generated_diagnosis' not in st.session_state:
-    st.session_state.generated_diagnosis = ""
-if 'config' not in st.session_state:
-    st.session_state.config = {}
-if 'student_name' not in st.session_state:
-    st.session_state.student_name = "Unknown"
-if 'num_questions' not in st.session_state:
-    st.session_state.num_questions = 5
+# 單份測驗的作答狀態：開始新測驗或回到首頁時依此表重置（新增作答相關的 key 請加在這裡）
+_QUIZ_STATE_DEFAULTS = {
+    'questions': [],
+    'current_q_index': 0,
+    'history': [],
+    'correct_count': 0,
+    'incorrect_items': [],
+    'show_explanation': False,
+    'user_answer': None,
+    'generated_diagnosis': "",
+    'diag_future': None,
+    'diag_chunks': [],  # 背景診斷已收到的文字片段，由工作執行緒 append，結果頁邊收邊顯示
+    'feedback': None,
+}
+_SESSION_DEFAULTS = {
+    'app_state': 'input',
+    **_QUIZ_STATE_DEFAULTS,
+    'seen_questions': set(),
+    'config': {},
+    'student_name': "Unknown",
+    'num_questions': 5,
+}
+for _key, _default in _SESSION_DEFAULTS.items():
+    if _key not in st.session_state:
+        # 複製一份，之後對 session 值的 append 等操作才不會改到預設表本身
+        st.session_state[_key] = copy.copy(_default)
+
+def _reset_state(defaults):
+    """依預設表將對應的 session 值重設為新的預設值副本"""
+    for key, default in defaults.items():
+        st.session_state[key] = copy.copy(default)
+
+def _reset_quiz_state():
+    """清空上一份測驗的題目、作答紀錄、診斷與回饋；config 與已做過的題目保留"""
+    _reset_state(_QUIZ_STATE_DEFAULTS)
+
+SESSION_IDLE_TIMEOUT = 30 * 60  # 秒；分頁閒置超過此時間，下次互動時即重置狀態
+
+def expire_idle_session():
+    """閒置過久的分頁釋放題目、作答紀錄與診斷，回到初始狀態（學生連結會重新解析參數）"""
+    now = time.monotonic()
+    last = st.session_state.get('last_activity', now)
+    st.session_state.last_activity = now
+    if now - last > SESSION_IDLE_TIMEOUT:
+        _reset_state(_SESSION_DEFAULTS)
+        st.session_state.pop('_qp_parsed', None)
 
 # [CSS 重構] 現代化 UI/UX 設計 - 高對比度與易讀性優化
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap');
-    :root {
-        --primary-color: #4F46E5;
-        --primary-hover: #4338CA;
-        --bg-color: #F3F4F6;
-        --card-bg: #FFFFFF;
-        --text-main: #1F2937;
-        --text-sub: #4B5563;
-    }
-    html, body, [class*="css"]:not([data-baseweb="menu"]):not([data-baseweb="popover"]) {
-        font-family: 'Inter', sans-serif;
-        color: var(--text-main) !important; 
-        background-color: var(--bg-color);
-    }
-    .stApp {
-        background-color: var(--bg-color);
-        background-image: radial-gradient(#E5E7EB 1px, transparent 1px);
-        background-size: 20px 20px;
-    }
-    h1, h2, h3, h4, h5, h6 {
-        color: #111827 !important;
-        font-weight: 700;
-        letter-spacing: -0.025em;
-    }
-    p, div, span {
-        color: var(--text-main);
-    }
-    div[data-testid="stForm"], div[data-testid="stVerticalBlock"] > div[style*="background-color"] {
-        background-color: var(--card-bg);
-        padding: 2rem;
-        border-radius: 16px;
-        box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1), 0 2px 4px -1px rgba(0, 0, 0, 0.06);
-        border: 1px solid #E5E7EB;
-        margin-bottom: 1.5rem;
-    }
-    /* 輸入框高對比度修正 */
-    div[data-baseweb="input"] > div {
-        background-color: #FFFFFF !important;
-        border: 1px solid #D1D5DB !important;
-        border-radius: 8px !important;
-    }
-    div[data-baseweb="input"] input {
-        color: #000000 !important;
-        caret-color: #000000 !important;
-        font-weight: 500 !important;
-    }
-    /* 代碼區塊高對比度修正 */
-    div[data-testid="stCodeBlock"] {
-        background-color: #FFFFFF !important;
-        border: 1px solid #D1D5DB !important;
-        border-radius: 8px !important;
-    }
-    div[data-testid="stCodeBlock"] code {
-        color: #000000 !important;
-        font-family: 'Courier New', Courier, monospace !important;
-    }
-    /* 下拉選單 — 觸發框 */
-    div[data-baseweb="select"] > div {
-        background-color: #FFFFFF !important;
-        color: #111827 !important;
-        border: 2px solid #D1D5DB !important;
-        border-radius: 8px !important;
-    }
-    div[data-baseweb="select"] span,
-    div[data-baseweb="select"] div[class*="placeholder"],
-    div[data-baseweb="select"] div[class*="singleValue"] {
-        color: #111827 !important;
-        font-weight: 500 !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+# 樣式放在 assets/app.css，由 load_css() 讀取一次後快取，inject_css() 於每次 rerun 以單一元素送出
+CSS_PATH = Path(__file__).parent / "assets" / "app.css"
+
+@st.cache_data
+def load_css():
+    """讀取全域樣式表並包成 <style> 區塊；檔案內容只在第一次呼叫時從磁碟讀取"""
+    return f"<style>\n{CSS_PATH.read_text(encoding='utf-8')}</style>"
 
 # 用 JS 將 dropdown 樣式注入到 document.head，才能覆蓋 Streamlit portal 層
-st.markdown("""
+_DROPDOWN_FIX_HTML = """
 <script>
 (function() {
     const css = `
@@ -251,75 +267,35 @@ st.markdown("""
     document.head.appendChild(style);
 })();
 </script>
-""", unsafe_allow_html=True)
-
-st.markdown("""
-<style>
-    /* Radio Button 選項高對比度修正 */
-    div[role="radiogroup"] label {
-        background-color: #FFFFFF !important;
-        padding: 12px 16px !important;
-        border-radius: 8px !important;
-        border: 1px solid #E5E7EB !important;
-        color: #1F2937 !important;
-        margin-bottom: 8px !important;
-        transition: all 0.2s ease;
-    }
-    div[role="radiogroup"] label p {
-        color: #1F2937 !important;
-        font-weight: 500 !important;
-        font-size: 1rem !important;
-    }
-    div[role="radiogroup"] label:hover {
-        border-color: var(--primary-color) !important;
-        background-color: #EEF2FF !important;
-    }
-    div[role="radiogroup"] label:hover p {
-        color: var(--primary-color) !important;
-    }
-    /* 按鈕樣式 */
-    div.stButton > button {
-        border-radius: 8px;
-        font-weight: 600;
-        border: 1px solid transparent;
-        transition: all 0.2s;
-        padding: 0.6rem 1.2rem;
-        background-color: var(--primary-color);
-        color: white !important;
-    }
-    div.stButton > button p {
-        color: white !important;
-    }
-    div.stButton > button:hover {
-        background-color: var(--primary-hover);
-        box-shadow: 0 4px 6px -1px rgba(79, 70, 229, 0.3);
-        transform: translateY(-1px);
-    }
-    /* 送出按鈕特別強化 */
-    div[data-testid="stFormSubmitButton"] button {
-        background-color: #111827 !important;
-        color: white !important;
-        width: 100%;
-        border-radius: 8px;
-        padding: 0.75rem;
-    }
-    div[data-testid="stFormSubmitButton"] button:hover {
-        background-color: #000000 !important;
-        box-shadow: 0 4px 12px rgba(0,0,0,0.15);
-    }
-    div[data-testid="stFormSubmitButton"] button p {
-        color: white !important;
-    }
-    .stProgress > div > div > div > div {
-        background-color: var(--primary-color);
-    }
-</style>
-""", unsafe_allow_html=True)
+"""
+
+def inject_css():
+    """送出全域樣式；Streamlit 會移除本次 rerun 未再送出的元素，因此每次 rerun 都需呼叫"""
+    st.markdown(load_css(), unsafe_allow_html=True)
+    st.markdown(_DROPDOWN_FIX_HTML, unsafe_allow_html=True)
 
 # ==========================================
 # 核心邏輯函式
 # ==========================================
 
+# 成長型思維回饋文案：依答對率分為四個區間
+_FEEDBACK_PERFECT = (
+    {"title": "🌟 完美的表現！你是這個單元的小小專家！", "msg": "你展現了非常扎實的理解能力，這代表你之前的努力都得到了回報。試著挑戰更難的題目，繼續擴展你的知識邊界吧！"},
+    {"title": "🏆 太棒了！完全制霸！", "msg": "你的細心與專注讓你獲得了滿分。請保持這份學習的熱情，你是其他同學的好榜樣！"},
+)
+_FEEDBACK_HIGH = (
+    {"title": "👍 表現優異！只差一點點就全對囉！", "msg": "你已經掌握了絕大部分的關鍵概念。只要再多一點點細心，下次一定能拿滿分。回頭看看那道錯題，那是你變更強的關鍵！"},
+    {"title": "✨ 很棒的成果！", "msg": "你的觀念非常清晰，大部分的問題都難不倒你。把那一點點小錯誤修正過來，你的知識網就完整了！"},
+)
+_FEEDBACK_MID = (
+    {"title": "🙂 做得不錯！基礎已經建立起來了！", "msg": "你已經懂了一半以上的內容，這是一個很好的開始。複習一下錯的題目，釐清那些模糊的觀念，你會進步神速喔！"},
+    {"title": "🌱 持續進步中！", "msg": "學習就像馬拉松，你已經跑了一半了。現在是停下來檢查裝備的好時機，把不清楚的地方弄懂，下半場會跑得更順！"},
+)
+_FEEDBACK_LOW = (
+    {"title": "📖 很好的學習機會！我們一起從基礎加油！", "msg": "別氣餒，每一個錯誤都是變聰明的機會。現在我們發現了哪些觀念還不熟，這比全部答對更有價值，因為我們知道該往哪裡努力了！"},
+    {"title": "💡 發現問題是解決問題的開始！", "msg": "這次測驗幫我們照亮了盲點。先別急著做新題目，花點時間把詳解看懂，把基礎打穩，下一次你一定會不一樣！"},
+)
+
 def get_growth_mindset_feedback(correct_count, total_q):
     """根據成長型思維生成正向回饋"""
     if total_q == 0:
@@ -328,25 +304,13 @@ def get_growth_mindset_feedback(correct_count, total_q):
     ratio = correct_count / total_q
     
     if ratio == 1.0:
-        messages = [
-            {"title": "🌟 完美的表現！你是這個單元的小小專家！", "msg": "你展現了非常扎實的理解能力，這代表你之前的努力都得到了回報。試著挑戰更難的題目，繼續擴展你的知識邊界吧！"},
-            {"title": "🏆 太棒了！完全制霸！", "msg": "你的細心與專注讓你獲得了滿分。請保持這份學習的熱情，你是其他同學的好榜樣！"}
-        ]
+        messages = _FEEDBACK_PERFECT
     elif ratio >= 0.8:
-        messages = [
-            {"title": "👍 表現優異！只差一點點就全對囉！", "msg": "你已經掌握了絕大部分的關鍵概念。只要再多一點點細心，下次一定能拿滿分。回頭看看那道錯題，那是你變更強的關鍵！"},
-            {"title": "✨ 很棒的成果！", "msg": "你的觀念非常清晰，大部分的問題都難不倒你。把那一點點小錯誤修正過來，你的知識網就完整了！"}
-        ]
+        messages = _FEEDBACK_HIGH
     elif ratio >= 0.6:
-        messages = [
-            {"title": "🙂 做得不錯！基礎已經建立起來了！", "msg": "你已經懂了一半以上的內容，這是一個很好的開始。複習一下錯的題目，釐清那些模糊的觀念，你會進步神速喔！"},
-            {"title": "🌱 持續進步中！", "msg": "學習就像馬拉松，你已經跑了一半了。現在是停下來檢查裝備的好時機，把不清楚的地方弄懂，下半場會跑得更順！"}
-        ]
+        messages = _FEEDBACK_MID
     else:
-        messages = [
-            {"title": "📖 很好的學習機會！我們一起從基礎加油！", "msg": "別氣餒，每一個錯誤都是變聰明的機會。現在我們發現了哪些觀念還不熟，這比全部答對更有價值，因為我們知道該往哪裡努力了！"},
-            {"title": "💡 發現問題是解決問題的開始！", "msg": "這次測驗幫我們照亮了盲點。先別急著做新題目，花點時間把詳解看懂，把基礎打穩，下一次你一定會不一樣！"}
-        ]
+        messages = _FEEDBACK_LOW
     
     return random.choice(messages)
 
@@ -355,85 +319,230 @@ def get_growth_mindset_feedback(correct_count, total_q):
 # 教師預先產生後，所有學生直接讀取，完全不打 API
 # ==========================================
 
+# 題庫同時寫入磁碟，worker 重啟或重新部署後仍可直接沿用，不必重打 API
+BANK_DIR = Path(__file__).parent / ".cache" / "question_bank"
+
 @st.cache_resource
 def get_question_bank():
-    """全 server 共享的題庫字典，key = 設定的 hash，value = 題目清單"""
-    return {}
+    """全 server 共享的題庫字典，key = 設定的 hash，value = 題目清單；首次建立時從磁碟載入"""
+    bank = {}
+    if BANK_DIR.is_dir():
+        for path in BANK_DIR.glob("*.json"):
+            try:
+                questions = _json_loads(path.read_bytes())
+            except Exception:
+                continue  # 無法解析的檔案略過，之後需要時重新生成
+            # 內容也要檢查：非清單或缺欄位的題目會讓抽題與作答畫面出錯，濾掉後沒剩任何題目就當作沒有快取
+            if isinstance(questions, list):
+                questions = [q for q in questions if _is_valid_question(q)]
+                if questions:
+                    bank[path.stem] = questions
+    return bank
+
+def _save_bank_entry(key, questions):
+    """將單一題庫寫入磁碟；寫入失敗（例如唯讀檔案系統）時只保留記憶體快取"""
+    try:
+        BANK_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = BANK_DIR / f"{key}.json.tmp"
+        tmp_path.write_bytes(_json_dumps(questions))
+        tmp_path.replace(BANK_DIR / f"{key}.json")
+    except OSError:
+        pass
+
+def _normalize_unit(unit):
+    """
+    將單元名稱正規化為快取用的 key：全形轉半形、忽略大小寫，並去除空白、標點與「的」，
+    讓「分數的加減」「分數加減」「分數 加減。」共用同一份題庫。
+    """
+    text = unicodedata.normalize("NFKC", unit).casefold()
+    return "".join(ch for ch in text if ch != "的" and unicodedata.category(ch)[0] not in "PZ" and not ch.isspace())
 
 def _make_cache_key(subject, grade, unit, assess_type_key, num_questions):
-    raw = f"{subject}|{grade}|{unit}|{assess_type_key}|{num_questions}"
+    raw = f"{subject}|{grade}|{_normalize_unit(unit)}|{assess_type_key}|{num_questions}"
     return hashlib.md5(raw.encode()).hexdigest()
 
-def prefetch_question_bank(subject, grade, unit, assess_type_key, num_questions):
-    """
-    教師端主動呼叫：預先生成題庫並存入全 server 共享快取。
-    之後所有學生 session 直接讀取，不再打 API。
-    """
-    bank = get_question_bank()
-    key = _make_cache_key(subject, grade, unit, assess_type_key, num_questions)
-    if key in bank:
-        return True, "（已有快取，直接使用）"
+BANK_QUESTIONS_PER_REQUEST = 5  # 每個 API 請求負責的題數
+BANK_MAX_WORKERS = 5            # 同時送出的請求上限，避免超過 API 每分鐘請求數
 
-    subject_map = {'chinese': '國語', 'math': '數學', 'science': '自然科學', 'social': '社會'}
-    assess_info = ASSESSMENT_TYPES[assess_type_key]
-    pool_size = max(num_questions * 3, 15)  # 題庫是需求量的 3 倍，最少 15 題
+# 去除模型回應前後的 ```json ... ``` 標記（允許前後有空白與換行）
+_FENCE_RE = re.compile(r"\A\s*```(?:json)?\s*|\s*```\s*\Z")
 
-    prompt = f"""
-    你是一位專業的台灣國小教師與教育測驗專家。請根據以下嚴格規範出 {pool_size} 題單選題作為題庫：
+# 審核介面與作答畫面都假設每題剛好四個選項
+BANK_OPTION_COUNT = 4
 
-    1. **基本資訊**：
-       - 對象：國小 {grade} 年級學生
-       - 科目：{subject_map.get(subject, subject)}
-       - 單元：{unit}
-       - 語言：繁體中文 (台灣用語)
+# 明確限制輸出長度以封頂最差情況的生成時間；gemini-2.5 的思考 token 也計入上限，故不可設得太緊
+BANK_GENERATION_CONFIG = {
+    "max_output_tokens": 8192,
+    "temperature": 0.7,
+    # 只用 JSON mode、不指定 response_schema：此版 SDK 無法指定欄位順序，schema 會讓模型依字母序輸出，
+    # 先寫 "ans" 才寫題目與 "reasoning"，破壞「先推導、再核對」的自我驗證；欄位順序改由 prompt 範例決定
+    "response_mime_type": "application/json",
+}
 
-    2. **嚴格的課程綱要對齊 (Strict Curriculum Alignment)**：
-       - **核心鐵律**：出題範圍必須嚴格限制在台灣教育部「十二年國民基本教育課程綱要」的 {grade} 年級學習內容。
+# 出題規範中與設定無關的部分放進 system_instruction，每次請求只送出各批次不同的變數
+BANK_SYSTEM_INSTRUCTION = textwrap.dedent("""
+    你是一位專業的台灣國小教師與教育測驗專家，負責依使用者指定的年級、科目、單元與評量類型出單選題作為題庫。
+
+    1. **嚴格的課程綱要對齊 (Strict Curriculum Alignment)**：
+       - **核心鐵律**：出題範圍必須嚴格限制在台灣教育部「十二年國民基本教育課程綱要」中指定年級的學習內容。
        - **絕對禁止超綱**：
          - 自然科學 3-4 年級：嚴禁「電壓」「電阻」「化學式」「原子」等國中概念。
          - 數學 1-2 年級：嚴禁「分數」「小數」「除法」。3-4 年級：嚴禁「代數符號」「負數」「圓周率」。
-       - 詞彙難度須符合 {grade} 年級認知發展階段。
+       - 詞彙難度須符合指定年級的認知發展階段。
+       - 語言：繁體中文 (台灣用語)
 
-    3. **評量類型專屬策略 (CRITICAL)**：
-       這是一份「{assess_info['label']}」。請務必遵守以下出題邏輯：
-       {assess_info['prompt_instruction']}
+    2. **評量類型專屬策略 (CRITICAL)**：請務必遵守使用者提供的評量類型出題邏輯。
 
-    4. **答案正確性自我驗證（CRITICAL — 最重要步驟）**：
+    3. **答案正確性自我驗證（CRITICAL — 最重要步驟）**：
        每出完一題，你必須在內心執行以下流程，再繼續下一題：
        - 步驟A【推導】：逐步寫出解題過程，得出答案。
        - 步驟B【核對】：確認你填入 "ans" 的索引（0=A, 1=B, 2=C, 3=D）對應的選項，確實等於步驟A得出的答案。
        - 步驟C【檢查誘答】：確認其他三個錯誤選項都確實是錯的。
        - **如果核對有誤，必須修正後才能輸出**。請將推導過程填入 "reasoning" 欄位（供教師審核用）。
 
-    5. **數學符號規範**：請直接使用 Unicode（+, -, ×, ÷, =, >, <），嚴禁 LaTeX 語法。分數用 "1/2" 表示。
+    4. **數學符號規範**：請直接使用 Unicode（+, -, ×, ÷, =, >, <），嚴禁 LaTeX 語法。分數用 "1/2" 表示。
 
-    請嚴格遵守以下 JSON 格式回傳，不要有任何 Markdown 標記：
+    5. **輸出格式**：請嚴格依照以下 JSON 格式與欄位順序回傳（先寫 "reasoning" 推導，再填 "ans"），不要有任何 Markdown 標記：
     [
-      {{
+      {
         "q": "題目內容",
         "options": ["選項A", "選項B", "選項C", "選項D"],
-        "ans": 0,
         "reasoning": "【推導過程】逐步說明為何答案是選項A，以及其他三項為何錯誤。",
+        "ans": 0,
         "explanation": "詳細解析，針對學生錯誤提供鷹架引導。",
         "bloomLevel": "認知層次"
-      }}
+      }
     ]
+""")
+
+# 每批次的出題 prompt：只含變數，以 format 填入。
+# 評量類型策略放最前面，同類型的請求共用「system_instruction + 策略」這段相同前綴。
+# 注意：隱式快取 (implicit caching) 在 2.5-flash 需前綴至少 1024 token，目前前綴約在門檻邊緣，未實測是否命中
+BANK_PROMPT_TMPL = textwrap.dedent("""
+    這是一份「{assess_label}」，出題邏輯如下：
+    {assess_instruction}
+
+    請出 {count} 題單選題：
+    - 對象：國小 {grade} 年級學生
+    - 科目：{subject}
+    - 單元：{unit}{part_note}
+""")
+
+def _build_bank_prompt(subject, grade, unit, assess_type_key, count, part, total_parts):
+    """組出單一批次的出題 prompt；題庫被拆成多批時，各批負責不同子概念以減少重複"""
+    assess_info = ASSESSMENT_TYPES[assess_type_key]
+    part_note = ""
+    if total_parts > 1:
+        part_note = f"\n- 分工：請將本單元拆成 {total_parts} 個子概念，本次只針對第 {part} 個子概念出題，避免與其他子概念重複。"
+
+    return BANK_PROMPT_TMPL.format(
+        count=count, grade=grade, subject=SUBJECT_MAP.get(subject, subject), unit=unit, part_note=part_note,
+        assess_label=assess_info['label'], assess_instruction=assess_info['prompt_instruction'],
+    )
+
+def _generate_bank_part(model, prompt, counts, slot):
+    """
+    送出單一批次的出題請求並解析為題目清單（在背景執行緒執行，不可呼叫 st.*）。
+    串流途中數 "q" 鍵出現的次數，寫入 counts[slot]，讓呼叫端可以逐題回報進度。
+    """
+    # 以串流方式接收，長題庫不必等整包回應才開始傳輸，也較不易逾時
+    response = model.generate_content(prompt, generation_config=BANK_GENERATION_CONFIG, stream=True)
+    text = ""
+    for chunk in response:
+        text += chunk.text
+        counts[slot] = text.count('"q"')
+    text = _FENCE_RE.sub("", text)
+    try:
+        questions = _json_loads(text)
+    except json.JSONDecodeError:
+        # 模型偶爾會在 JSON 前後多講幾句，退而擷取最外層的 [...] 再解析一次
+        questions = _json_loads(text[text.index('['):text.rindex(']') + 1])
+    questions = [q for q in questions if _is_valid_question(q)] if isinstance(questions, list) else []
+    if not questions:
+        # 視為失敗批次，讓呼叫端重送並回報原因
+        raise ValueError("回應中沒有格式正確的題目")
+    return questions
+
+def _is_valid_question(q):
+    """檢查單題結構：必要欄位齊全、剛好四個字串選項、ans 為有效索引；不合格的題目直接捨棄"""
+    if not isinstance(q, dict) or not isinstance(q.get('q'), str) or not isinstance(q.get('explanation'), str):
+        return False
+    options, ans = q.get('options'), q.get('ans')
+    return (isinstance(options, list) and len(options) == BANK_OPTION_COUNT
+            and all(isinstance(o, str) for o in options)
+            and type(ans) is int and 0 <= ans < BANK_OPTION_COUNT)
+
+def prefetch_question_bank(subject, grade, unit, assess_type_key, num_questions, on_progress=None):
+    """
+    教師端主動呼叫：預先生成題庫並存入全 server 共享快取。
+    之後所有學生 session 直接讀取，不再打 API。
+    題庫拆成數個小批次平行生成，總等待時間約等於最慢的一批，而非全部相加。
+    on_progress(done, total) 會在呼叫端執行緒約每 0.5 秒被呼叫一次（done / total 為已生成 / 預計題數），可用來更新畫面進度。
     """
+    bank = get_question_bank()
+    key = _make_cache_key(subject, grade, unit, assess_type_key, num_questions)
+    if key in bank:
+        return True, "（已有快取，直接使用）"
+
+    pool_size = max(num_questions * 3, 15)  # 題庫是需求量的 3 倍，最少 15 題
+    total_parts = -(-pool_size // BANK_QUESTIONS_PER_REQUEST)
+    base, extra = divmod(pool_size, total_parts)
+    prompts = [
+        _build_bank_prompt(subject, grade, unit, assess_type_key, base + (1 if i < extra else 0), i + 1, total_parts)
+        for i in range(total_parts)
+    ]
+
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        text = response.text.strip()
-        if text.startswith("```json"):
-            text = text[7:]
-        elif text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-        questions = json.loads(text)
+        model = get_model(GEMINI_MODEL, BANK_SYSTEM_INSTRUCTION)
+        parts = [None] * total_parts
+        counts = [0] * total_parts  # 各批次目前已串流出的題數，由背景執行緒更新
+        last_progress = None
+        error = None
+        for _ in range(2):  # 失敗的批次只重送一次
+            pending = [i for i, part in enumerate(parts) if part is None]
+            if not pending:
+                break
+            with ThreadPoolExecutor(max_workers=min(len(pending), BANK_MAX_WORKERS)) as executor:
+                futures = {executor.submit(_generate_bank_part, model, prompts[i], counts, i): i for i in pending}
+                not_done = set(futures)
+                while not_done:
+                    # 不等整批完成：每 0.5 秒醒來一次回報串流進度
+                    done, not_done = wait(not_done, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = futures[future]
+                        try:
+                            parts[i] = future.result()
+                            counts[i] = len(parts[i])
+                        except Exception as e:
+                            error = e
+                            counts[i] = 0
+                    progress = min(sum(counts), pool_size)
+                    if on_progress is not None and progress != last_progress:
+                        on_progress(progress, pool_size)
+                        last_progress = progress
+
+        # 任何一批重送後仍失敗就不建立題庫：各批負責不同子概念，缺批代表缺一塊單元內容，
+        # 而建立後的題庫會被快取與存檔，殘缺的結果會一直沿用下去
+        failed = sum(part is None for part in parts)
+        if failed:
+            return False, f"生成失敗：{failed}/{total_parts} 批題目未成功生成（{error}）"
+
+        # 合併各批次並去除題目文字完全相同的重複題
+        questions = []
+        seen = set()
+        for part in parts:
+            for q in part or []:
+                if q['q'] not in seen:
+                    seen.add(q['q'])
+                    questions.append(q)
+        if len(questions) < num_questions:
+            return False, f"生成失敗：有效題目只有 {len(questions)} 題，少於測驗所需的 {num_questions} 題"
+
         # 數學科：用 Python 嘗試自動驗算，標記可疑題目
         if subject == 'math':
             questions = _verify_math_questions(questions)
         bank[key] = questions
+        _save_bank_entry(key, questions)
         valid = sum(1 for q in questions if not q.get('_suspicious', False))
         return True, f"題庫已建立（共 {len(questions)} 題，其中 {valid} 題通過自動驗算）"
     except Exception as e:
@@ -444,7 +553,6 @@ def _verify_math_questions(questions):
     數學題自動驗算：嘗試用 Python eval 計算題目中的算式，
     若計算結果與標記答案不符，標記 _suspicious=True 供教師注意。
     """
-    import re
     for q in questions:
         try:
             text = q['q']
@@ -467,10 +575,19 @@ def _verify_math_questions(questions):
             pass  # 無法解析的題目不標記，不影響流程
     return questions
 
-def generate_questions(subject, grade, unit, assess_type_key, num_questions=5):
+def _draw_questions(pool, num_questions, exclude):
+    """從題庫隨機抽題，優先抽 exclude（已作答過的題目文字）以外的題目，不足時才補入做過的題"""
+    pool = pool.copy()
+    random.shuffle(pool)
+    # sort 為穩定排序：未做過的排前面，兩組內仍維持隨機順序
+    pool.sort(key=lambda q: q['q'] in exclude)
+    return pool[:num_questions]
+
+def generate_questions(subject, grade, unit, assess_type_key, num_questions=5, exclude=frozenset()):
     """
     學生端取題：從全 server 共享題庫隨機抽取，不打 API。
     若題庫尚未建立（例如教師試用），則臨時生成。
+    exclude 為此學生已做過的題目文字；「再練習一次」時會優先抽新題。
     """
     if not API_KEY:
         st.error("未設定 API Key")
@@ -480,44 +597,141 @@ def generate_questions(subject, grade, unit, assess_type_key, num_questions=5):
     key = _make_cache_key(subject, grade, unit, assess_type_key, num_questions)
 
     if key in bank:
-        pool = bank[key].copy()
-        random.shuffle(pool)
-        return pool[:num_questions]
+        return _draw_questions(bank[key], num_questions, exclude)
 
     # 題庫不存在（教師試用情境）→ 臨時生成，並順手存入快取
     ok, msg = prefetch_question_bank(subject, grade, unit, assess_type_key, num_questions)
     if ok and key in bank:
-        pool = bank[key].copy()
-        random.shuffle(pool)
-        return pool[:num_questions]
+        return _draw_questions(bank[key], num_questions, exclude)
 
     st.error("題目生成失敗，請稍後再試")
     return []
-def generate_diagnosis(history_items, grade, subject, unit):
-    """生成教師專用的簡短診斷"""
-    if not API_KEY: return "未設定 API Key。"
-    
-    error_details = ""
-    for idx, item in enumerate(history_items):
-        q = item['question']
-        error_details += f"錯題 {idx+1}: 題目[{q['q']}] 誤選[{q['options'][item['user_answer']]}] 正解[{q['options'][item['ans']]}]\n"
 
-    prompt = f"""
-    你是一位資深的教育心理學家。請根據以下學生的錯題紀錄，進行「極簡短」的診斷。
-    
-    背景：{grade}年級 {subject} ({unit})
-    錯題紀錄：{error_details}
+DIAGNOSIS_CACHE_MAX_ENTRIES = 256
+DIAGNOSIS_MAX_WORKERS = 32  # 診斷是純網路等待，需容納整班同時交卷；每個 session 同時最多一個
+
+# 診斷只要求 30-50 字，上限保留給模型的思考 token；低溫讓輸出更聚焦、少贅詞
+DIAGNOSIS_GENERATION_CONFIG = {"max_output_tokens": 1024, "temperature": 0.3}
+
+DIAGNOSIS_SYSTEM_INSTRUCTION = textwrap.dedent("""
+    你是一位資深的教育心理學家。請根據使用者提供的學生錯題紀錄，進行「極簡短」的診斷。
 
     **輸出要求**：
     請務必精簡，讓教師能在 **10秒內 (約30-50字)** 快速掌握重點。
     請直接使用以下格式列點：
     1. 核心迷思：(一句話點出最關鍵的錯誤觀念)
     2. 教學建議：(一句話提供具體解法)
+""")
+
+DIAGNOSIS_PROMPT_TMPL = textwrap.dedent("""
+    背景：{grade}年級 {subject} ({unit})
+    錯題紀錄：{error_details}
+""")
+
+@st.cache_resource
+def get_diagnosis_cache():
+    """
+    全 server 共享的診斷快取：entries 的 key = 診斷 prompt 的 hash，value = 診斷文字。
+    最多 DIAGNOSIS_MAX_WORKERS 個背景執行緒會同時寫入，淘汰與寫入須持有 lock。
+    """
+    return types.SimpleNamespace(entries={}, lock=threading.Lock())
+
+def generate_diagnosis(history_items, grade, subject, unit, model=None, cache=None):
+    """
+    生成教師專用的簡短診斷（generator，逐段產出文字，由背景工作收集後在結果頁邊收邊顯示）。
+    model / cache 可由呼叫端先取得後傳入，背景執行緒中才不需呼叫 st.cache_resource。
+    """
+    # 只錯一題時資訊有限，不值得多一次 API 往返，直接套用模板
+    if len(history_items) == 1:
+        item = history_items[0]
+        q_text = item['question']['q']
+        if len(q_text) > 20:
+            q_text = q_text[:20] + "…"
+        yield (f"1. 核心迷思：「{q_text}」誤選「{item['user_text']}」，正解為「{item['ans_text']}」。\n"
+               "2. 教學建議：請帶學生複習該題解析，確認觀念後再練習同類題。")
+        return
+
+    if not API_KEY:
+        yield "未設定 API Key。"
+        return
+    
+    error_details = "\n".join(
+        f"錯題 {idx+1}: 題目[{item['question']['q']}] 誤選[{item['user_text']}] 正解[{item['ans_text']}]"
+        for idx, item in enumerate(history_items)
+    )
+    prompt = DIAGNOSIS_PROMPT_TMPL.format(grade=grade, subject=subject, unit=unit, error_details=error_details)
+    # 相同的錯題組合（例如同一份題庫下常見的錯法）直接沿用先前的診斷
+    if cache is None:
+        cache = get_diagnosis_cache()
+    key = hashlib.md5(prompt.encode()).hexdigest()
+    cached = cache.entries.get(key)  # 單次 get 為原子操作，不怕與其他執行緒的淘汰交錯
+    if cached is not None:
+        yield cached
+        return
+
+    # yield 放在 try 之外：串流被 rerun 中斷時 GeneratorExit 才能正常結束 generator
+    parts = []
+    try:
+        if model is None:
+            model = get_model(GEMINI_MODEL, DIAGNOSIS_SYSTEM_INSTRUCTION)
+        stream = iter(model.generate_content(prompt, generation_config=DIAGNOSIS_GENERATION_CONFIG, stream=True))
+    except Exception:
+        yield "無法生成診斷報告。"
+        return
+    while True:
+        try:
+            text = next(stream).text
+        except StopIteration:
+            break
+        except Exception:
+            # 已送出部分內容時不再接上錯誤訊息；兩種情況都不寫入快取
+            if not parts:
+                yield "無法生成診斷報告。"
+            return
+        parts.append(text)
+        yield text
+
+    # 只快取成功的結果；超過上限時淘汰最早寫入的項目
+    with cache.lock:
+        entries = cache.entries
+        if key not in entries and len(entries) >= DIAGNOSIS_CACHE_MAX_ENTRIES:
+            entries.pop(next(iter(entries)))
+        entries[key] = "".join(parts)
+
+@st.cache_resource
+def get_diagnosis_executor():
+    """全 server 共用的背景執行緒池，用來提前產生診斷"""
+    return ThreadPoolExecutor(max_workers=DIAGNOSIS_MAX_WORKERS)
+
+def _collect_diagnosis(history_items, grade, subject, unit, model, cache, chunks):
     """
+    在背景執行緒中跑完診斷串流並回傳完整文字（不可呼叫 st.*）。
+    每收到一段就 append 到 chunks，結果頁可在完成前先顯示已收到的部分。
+    """
+    for text in generate_diagnosis(history_items, grade, subject, unit, model=model, cache=cache):
+        chunks.append(text)
+    return "".join(chunks)
+
+DIAGNOSIS_PENDING_MSG = "⏳ AI 正在分析學習斷層..."
+
+def _show_diagnosis_progress(placeholder, chunks):
+    """顯示背景診斷目前的進度：已有文字就顯示已收到的部分，否則顯示等待訊息"""
+    if chunks:
+        placeholder.markdown("".join(chunks) + " ▌")
+    else:
+        placeholder.info(DIAGNOSIS_PENDING_MSG)
+
+def _diagnosis_result(future, placeholder, chunks):
+    """
+    取回背景診斷結果，等待期間每 0.2 秒把已串流到的文字更新到 placeholder。
+    持續送出元素也讓 Streamlit 有機會檢查新的 rerun，教師/學生點擊按鈕時可立即中斷等待。
+    背景工作拋出例外時回傳錯誤訊息，不讓結果頁崩潰。
+    """
+    while not wait([future], timeout=0.2).done:
+        _show_diagnosis_progress(placeholder, chunks)
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        return model.generate_content(prompt).text
-    except:
+        return future.result()
+    except Exception:
         return "無法生成診斷報告。"
 
 # ==========================================
@@ -529,15 +743,9 @@ def render_teacher_input_screen():
     st.caption("設定評量參數並產生學生連結")
 
     with st.container(border=True):
-        subject_map = {'chinese':'國語', 'math':'數學', 'science':'自然科學', 'social':'社會'}
-        subject_keys = list(subject_map.keys())
-        subject_labels = list(subject_map.values())
-        subject_label = st.radio("科目領域", subject_labels, horizontal=True)
-        subject = subject_keys[subject_labels.index(subject_label)]
-
-        grade_labels = [f"{i} 年級" for i in range(1, 7)]
-        grade_label = st.radio("年級", grade_labels, horizontal=True)
-        grade = int(grade_label[0])
+        subject = st.radio("科目領域", list(SUBJECT_MAP), format_func=SUBJECT_MAP.__getitem__, horizontal=True)
+
+        grade = st.radio("年級", list(GRADE_LABELS), format_func=GRADE_LABELS.__getitem__, horizontal=True)
         
         unit = st.text_input("單元/主題關鍵字", placeholder="例如：分數的加減")
         
@@ -547,8 +755,8 @@ def render_teacher_input_screen():
 
         # 顯示評量類型的詳細說明，幫助教師選擇
         assess_type = st.radio("評量類型", 
-                               options=['placement', 'diagnostic', 'formative_small', 'formative_large', 'summative'],
-                               format_func=lambda x: f"{ASSESSMENT_TYPES[x]['label']} - {ASSESSMENT_TYPES[x]['desc']}")
+                               options=list(ASSESSMENT_TYPES),
+                               format_func=ASSESSMENT_LABEL_DESC.__getitem__)
         
         st.markdown("---")
         st.markdown("### 🔗 產生學生連結")
@@ -573,8 +781,12 @@ def render_teacher_input_screen():
                 return
 
             # ── 步驟一：預先生成題庫（存入全 server 共享快取）──
-            with st.spinner("⏳ 正在預先建立題庫，完成後學生才可掃碼進入..."):
-                ok, msg = prefetch_question_bank(subject, grade, unit, assess_type, num_questions)
+            with st.status("⏳ 正在預先建立題庫，完成後學生才可掃碼進入...") as status:
+                ok, msg = prefetch_question_bank(
+                    subject, grade, unit, assess_type, num_questions,
+                    on_progress=lambda done, total: status.update(label=f"⏳ 正在預先建立題庫（已生成 {done}/{total} 題）...")
+                )
+                status.update(label="✅ 題庫建立完成" if ok else "❌ 題庫建立失敗", state="complete" if ok else "error")
 
             if not ok:
                 st.error(f"❌ 題庫建立失敗：{msg}，請重試。")
@@ -584,11 +796,8 @@ def render_teacher_input_screen():
 
             # ── 步驟二：產生學生連結 ──
             base_url = base_url_input.rstrip("/")
-            params = {
-                "role": "student", "subject": subject, "grade": grade, "unit": unit, "type": assess_type,
-                "num_q": num_questions
-            }
-            query_string = urllib.parse.urlencode(params)
+            params = dict(zip(_PARAM_KEYS, ("student", subject, grade, unit, assess_type, num_questions)))
+            query_string = urllib.parse.urlencode(params, doseq=True, quote_via=urllib.parse.quote)
             full_url = f"{base_url}/?{query_string}"
             
             st.code(full_url, language="text")
@@ -612,6 +821,7 @@ def render_teacher_input_screen():
                 st.warning(f"⚠️ 有 {len(suspicious)} 題被自動驗算標記為**可疑**，建議優先檢查。")
             with st.expander(f"📋 檢視並編輯題庫（共 {len(pool)} 題）", expanded=False):
                 to_delete = []
+                edited = False
                 for i, q in enumerate(pool):
                     label_color = "🔴" if q.get('_suspicious') else "🟢"
                     with st.container(border=True):
@@ -620,21 +830,27 @@ def render_teacher_input_screen():
                             st.caption(f"驗算備註：{q['_verify_note']}")
                         # 可編輯題目文字
                         new_q = st.text_area(f"題目_{i}", value=q['q'], key=f"edit_q_{review_key}_{i}", label_visibility="collapsed")
-                        pool[i]['q'] = new_q
+                        if new_q != q['q']:
+                            pool[i]['q'] = new_q
+                            edited = True
                         # 顯示選項與正確答案
                         for j, opt in enumerate(q['options']):
                             marker = "✅" if j == q['ans'] else "　"
                             new_opt = st.text_input(f"選項_{i}_{j}", value=opt, key=f"edit_opt_{review_key}_{i}_{j}", label_visibility="collapsed")
-                            pool[i]['options'][j] = new_opt
+                            if new_opt != opt:
+                                pool[i]['options'][j] = new_opt
+                                edited = True
                             if j == q['ans']:
                                 st.caption(f"{marker} 目前正確答案")
                         # 修改正確答案
                         new_ans = st.radio(
-                            "正確答案", options=[0,1,2,3],
+                            "正確答案", options=list(range(BANK_OPTION_COUNT)),
                             format_func=lambda x: f"{['A','B','C','D'][x]}. {pool[i]['options'][x]}",
                             index=q['ans'], key=f"edit_ans_{review_key}_{i}", horizontal=True
                         )
-                        pool[i]['ans'] = new_ans
+                        if new_ans != q['ans']:
+                            pool[i]['ans'] = new_ans
+                            edited = True
                         # 顯示 reasoning
                         if q.get('reasoning'):
                             st.caption(f"🧠 AI 推導：{q['reasoning']}")
@@ -643,8 +859,11 @@ def render_teacher_input_screen():
                             to_delete.append(i)
                 if to_delete:
                     bank[review_key] = [q for idx, q in enumerate(pool) if idx not in to_delete]
+                    _save_bank_entry(review_key, bank[review_key])
                     st.success(f"已刪除 {len(to_delete)} 題，題庫剩餘 {len(bank[review_key])} 題。")
                     st.rerun()
+                elif edited:
+                    _save_bank_entry(review_key, pool)
         else:
             st.info("請先點擊「產生連結並預先建立題庫」，再進行審核。")
 
@@ -661,9 +880,7 @@ def render_student_welcome_screen():
     st.markdown("## 👋 歡迎來到線上評量")
     
     cfg = st.session_state.config
-    subject_map = {'chinese': '國語', 'math': '數學', 'science': '自然科學', 'social': '社會'}
-    
-    st.info(f"📋 測驗資訊：{cfg['grade']} 年級 {subject_map.get(cfg['subject'], '')} - {cfg['unit']}")
+    st.info(f"📋 測驗資訊：{cfg['grade']} 年級 {SUBJECT_MAP.get(cfg['subject'], '')} - {cfg['unit']}")
     st.caption("本測驗將由 AI 老師為您即時生成題目，請放輕鬆作答。")
     
     # [新增] 學生姓名輸入
@@ -680,22 +897,30 @@ def start_quiz_generation():
     """開始生成題目並重置相關狀態"""
     cfg = st.session_state.config
     with st.spinner("正在準備試卷中..."):
-        questions = generate_questions(cfg['subject'], cfg['grade'], cfg['unit'], cfg['assess_type'], cfg.get('num_questions', 5))
+        questions = generate_questions(cfg['subject'], cfg['grade'], cfg['unit'], cfg['assess_type'],
+                                       cfg.get('num_questions', 5), exclude=st.session_state.seen_questions)
         if questions:
-            # 重置所有與題目相關的狀態
+            st.session_state.seen_questions.update(q['q'] for q in questions)
+            # 重置所有與題目相關的狀態（含解析顯示與作答選擇）
+            _reset_quiz_state()
             st.session_state.questions = questions
-            st.session_state.current_q_index = 0
-            st.session_state.history = []
-            st.session_state.generated_diagnosis = ""
-            
-            # 強制重置解析狀態
-            st.session_state.show_explanation = False 
-            st.session_state.user_answer = None 
-            
             st.session_state.app_state = 'quiz'
             st.rerun()
 
+def _on_submit_answer(q_index):
+    """送出答案的 callback：在 fragment 重跑前就寫入作答狀態，不必再額外 st.rerun 一次"""
+    user_idx = st.session_state[f"radio_q{q_index}"]
+    if user_idx is not None:
+        st.session_state.user_answer = user_idx
+        st.session_state.show_explanation = True
+
+# 注意：作答流程是每次點擊都會重跑的熱路徑，請勿在此使用 time.sleep 等阻塞式等待；
+# 需要等待 API 的工作請交給背景執行緒（見 get_diagnosis_executor）
+@st.fragment
 def render_quiz_screen():
+    """作答畫面（fragment）：題內互動只重跑此區塊，切換到結果頁時才整頁 rerun"""
+    # fragment 重跑不經過 main()，需自行更新活動時間，避免作答中被判定為閒置
+    st.session_state.last_activity = time.monotonic()
     q_index = st.session_state.current_q_index
     questions = st.session_state.questions
     
@@ -712,30 +937,29 @@ def render_quiz_screen():
     total_q = len(questions)
 
     st.progress((q_index + 1) / total_q)
-    st.markdown(f"### Q{q_index + 1} / {total_q}")
+    st.subheader(f"Q{q_index + 1} / {total_q}", anchor=False)
     st.caption(f"🧠 認知層次：{current_q.get('bloomLevel', '綜合')}")
     st.markdown(f"#### {current_q['q']}")
     
     disable_interaction = st.session_state.show_explanation
 
     with st.form(key=f"q_form_{q_index}"):
-        user_choice = st.radio(
+        # 選項以索引作為值，widget 直接回傳 int，不必再用選項文字反查
+        user_idx = st.radio(
             "請選擇答案：", 
-            current_q['options'], 
+            range(len(current_q['options'])), 
+            format_func=current_q['options'].__getitem__,
             index=st.session_state.user_answer,
             # 移除 timestamp key，確保提交後可保持選取狀態
             key=f"radio_q{q_index}", 
             disabled=disable_interaction
         )
-        submitted = st.form_submit_button("送出答案", disabled=disable_interaction)
+        submitted = st.form_submit_button("送出答案", disabled=disable_interaction,
+                                          on_click=_on_submit_answer, args=(q_index,))
     
-    if submitted:
-        if user_choice is None:
-            st.warning("請先選擇一個答案")
-        else:
-            st.session_state.user_answer = current_q['options'].index(user_choice)
-            st.session_state.show_explanation = True
-            st.rerun()
+    # 已選答案時 callback 已在本次 rerun 前更新狀態，這裡只需處理未選擇的提示
+    if submitted and st.session_state.user_answer is None:
+        st.warning("請先選擇一個答案")
 
     if st.session_state.show_explanation:
         ans_idx = current_q['ans']
@@ -747,30 +971,55 @@ def render_quiz_screen():
             
         with st.container(border=True):
             st.markdown(f"**📖 解析：**\n\n{current_q['explanation']}")
-        
+
+        # 作答當下就算好選項文字與答對統計，結果頁不必再逐題重算
+        item = {
+            'question': current_q, 'user_answer': user_idx, 'ans': ans_idx, 'isCorrect': is_correct,
+            'user_text': current_q['options'][user_idx], 'ans_text': current_q['options'][ans_idx]
+        }
+
+        # 最後一題：學生閱讀解析的同時，在背景先產生教師診斷，結果頁就不必再等 API
+        if q_index == total_q - 1 and st.session_state.diag_future is None:
+            pending_items = st.session_state.incorrect_items + ([] if is_correct else [item])
+            if len(pending_items) > 1:  # 只錯一題時使用模板，不需背景呼叫
+                cfg = st.session_state.config
+                st.session_state.diag_future = get_diagnosis_executor().submit(
+                    _collect_diagnosis, pending_items,
+                    cfg.get('grade', 'unknown'), cfg.get('subject', 'unknown'), cfg.get('unit', 'unknown'),
+                    get_model(GEMINI_MODEL, DIAGNOSIS_SYSTEM_INSTRUCTION), get_diagnosis_cache(),
+                    st.session_state.diag_chunks
+                )
+
         if st.button("下一題 ➡️", use_container_width=True):
-            st.session_state.history.append({
-                'question': current_q, 'user_answer': user_idx, 'ans': ans_idx, 'isCorrect': is_correct
-            })
+            st.session_state.history.append(item)
+            if is_correct:
+                st.session_state.correct_count += 1
+            else:
+                st.session_state.incorrect_items.append(item)
             if q_index < total_q - 1:
                 st.session_state.current_q_index += 1
                 st.session_state.show_explanation = False
                 st.session_state.user_answer = None
-                st.rerun()
+                st.rerun(scope="fragment")
             else:
+                # 狀態機切換需由外層 main() 重新路由，因此整頁 rerun
                 st.session_state.app_state = 'result'
                 st.rerun()
 
 def render_result_screen():
     history = st.session_state.history
-    correct_count = sum(1 for h in history if h['isCorrect'])
+    correct_count = st.session_state.correct_count
+    incorrect_items = st.session_state.incorrect_items
     total_q = len(history)
     config = st.session_state.config
 
     if correct_count == total_q: st.balloons()
 
     # 確保 total_q 不為 0
-    feedback = get_growth_mindset_feedback(correct_count, total_q) if total_q > 0 else {"title": "Error", "msg": "無題目數據"}
+    # 回饋文案每次測驗只抽一次，避免結果頁 rerun 時換成另一句
+    if st.session_state.feedback is None:
+        st.session_state.feedback = get_growth_mindset_feedback(correct_count, total_q) if total_q > 0 else {"title": "Error", "msg": "無題目數據"}
+    feedback = st.session_state.feedback
 
     st.markdown("<div style='text-align: center;'>", unsafe_allow_html=True)
     st.title(feedback['title'])
@@ -783,23 +1032,34 @@ def render_result_screen():
 
     st.divider()
 
-    # 教師專用診斷 (Lazy Generation)
-    incorrect_items = [h for h in history if not h['isCorrect']]
-    if st.session_state.generated_diagnosis == "":
-        if incorrect_items:
-            # 確保 config 有值
-            grade = config.get('grade', 'unknown')
-            subject = config.get('subject', 'unknown')
-            unit = config.get('unit', 'unknown')
-
-            with st.spinner("AI 正在分析學習斷層..."):
-                diag = generate_diagnosis(incorrect_items, grade, subject, unit)
-                st.session_state.generated_diagnosis = diag
-        else:
-            st.session_state.generated_diagnosis = "表現優異，無顯著迷思概念。"
-
+    # 教師專用診斷：錯兩題以上時已在最後一題於背景生成，這裡邊收邊顯示；只錯一題時直接套用模板
+    diag_placeholder = None
     with st.expander("👨‍🏫 教師專用：學習診斷分析"):
-        st.markdown(st.session_state.generated_diagnosis)
+        if st.session_state.generated_diagnosis == "":
+            diag_future = st.session_state.diag_future
+            if diag_future is not None:
+                # 最後一題時已在背景送出，通常此時已完成；若還沒好，先顯示已收到的部分，等頁面其餘部分畫完再回來續寫
+                diag_chunks = st.session_state.diag_chunks
+                diag_placeholder = st.empty()
+                if wait([diag_future], timeout=0.1).done:
+                    st.session_state.generated_diagnosis = _diagnosis_result(diag_future, diag_placeholder, diag_chunks)
+                    diag_placeholder.markdown(st.session_state.generated_diagnosis)
+                    diag_placeholder = None
+                else:
+                    _show_diagnosis_progress(diag_placeholder, diag_chunks)
+            elif incorrect_items:
+                # 只錯一題（未送背景工作）：generate_diagnosis 直接回傳模板，不打 API
+                grade = config.get('grade', 'unknown')
+                subject = config.get('subject', 'unknown')
+                unit = config.get('unit', 'unknown')
+
+                st.session_state.generated_diagnosis = "".join(generate_diagnosis(incorrect_items, grade, subject, unit))
+                st.markdown(st.session_state.generated_diagnosis)
+            else:
+                st.session_state.generated_diagnosis = "表現優異，無顯著迷思概念。"
+                st.markdown(st.session_state.generated_diagnosis)
+        else:
+            st.markdown(st.session_state.generated_diagnosis)
 
     st.divider()
     
@@ -807,47 +1067,61 @@ def render_result_screen():
         st.subheader("📝 錯題回顧")
         for item in incorrect_items:
             q = item['question']
+            # 每題合併成單一 markdown 元素，減少前端逐一解析與渲染的元素數
             with st.container(border=True):
-                st.markdown(f"**Q: {q['q']}**")
-                st.markdown(f"❌ 你的答案: {q['options'][item['user_answer']]}")
-                st.markdown(f"✅ 正確答案: {q['options'][item['ans']]}")
-                st.markdown(f"💡 **解析**: {q['explanation']}")
-
-    if st.query_params.get("role") == "student":
+                st.markdown(
+                    f"**Q: {q['q']}**\n\n"
+                    f"❌ 你的答案: {item['user_text']}\n\n"
+                    f"✅ 正確答案: {item['ans_text']}\n\n"
+                    f"💡 **解析**: {q['explanation']}"
+                )
+
+    if st.session_state.qp.get("role") == "student":
         if st.button("🔄 再練習一次 (相同單元)", type="primary", use_container_width=True):
             st.session_state.app_state = 'student_ready' 
             start_quiz_generation()
     else:
         if st.button("🔄 回到首頁", type="primary", use_container_width=True):
-            # 回到首頁時，徹底清空所有狀態，防止殘留
+            # 回到首頁時，徹底清空所有作答狀態，防止殘留
+            _reset_quiz_state()
+            st.session_state.seen_questions = set()
             st.session_state.app_state = 'input'
-            st.session_state.questions = []
-            st.session_state.history = []
-            st.session_state.current_q_index = 0
-            st.session_state.show_explanation = False
-            st.session_state.user_answer = None
-            st.session_state.generated_diagnosis = ""
             st.rerun()
 
+    # 錯題回顧與按鈕都已顯示，學生不必等診斷；最後才阻塞取回背景結果並填入預留位置
+    if diag_placeholder is not None:
+        st.session_state.generated_diagnosis = _diagnosis_result(st.session_state.diag_future, diag_placeholder,
+                                                                 st.session_state.diag_chunks)
+        diag_placeholder.markdown(st.session_state.generated_diagnosis)
+
 # ==========================================
 # 主程式進入點
 # ==========================================
 
 def main():
-    if "role" in st.query_params and st.query_params["role"] == "student":
-        if st.session_state.app_state == 'input':
+    inject_css()
+    expire_idle_session()
+    if API_KEY:
+        warm_up_connection()
+
+    # 學生連結參數每個 session 只需解析一次，之後的 rerun 直接沿用 config
+    if not st.session_state.get('_qp_parsed'):
+        # 一次轉成一般 dict 存起來，之後（例如結果頁判斷角色）不必再讀 st.query_params
+        qp = st.session_state.qp = dict(st.query_params)
+        if qp.get("role") == "student":
             try:
                 st.session_state.config = {
-                    "subject": st.query_params["subject"],
-                    "grade": st.query_params["grade"],
-                    "unit": st.query_params["unit"],
-                    "assess_type": st.query_params["type"],
-                    "num_questions": int(st.query_params.get("num_q", 5))
+                    "subject": qp["subject"],
+                    "grade": int(qp["grade"]),  # 與教師端一致使用 int
+                    "unit": qp["unit"],
+                    "assess_type": qp["type"],
+                    "num_questions": int(qp.get("num_q", 5))
                 }
                 st.session_state.app_state = 'student_ready'
             except Exception:
                 st.error("連結參數有誤，請聯繫教師。")
                 return
+        st.session_state._qp_parsed = True
 
     if st.session_state.app_state == 'input':
         render_teacher_input_screen()